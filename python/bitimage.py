@@ -37,17 +37,78 @@
 #
 
 import wx
+import collections
+import pclparse
+
+
+class BandCache:
+    """
+    Bounded LRU cache of rendered bands. Bands are keyed by the digest
+    of their packed raster data, so bands that look the same in two
+    captures, like graticules and softkey labels, are only rendered once.
+    """
+
+    def __init__(self, maxbytes = 16 * 1024 * 1024):
+        self.maxbytes = maxbytes
+        self.bands = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    def Get(self, key):
+        """
+        Returns the bitmap stored under key, or None.
+        """
+        bitmap = self.bands.pop(key, None)
+        if bitmap is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.bands[key] = bitmap
+        return bitmap
+
+
+    def Put(self, key, bitmap):
+        """
+        Stores a bitmap, dropping the least recently used ones when the
+        cache grows beyond maxbytes.
+        """
+        self.bands[key] = bitmap
+        self.bytes += self.BitmapSize(bitmap)
+        while self.bytes > self.maxbytes and len(self.bands) > 1:
+            (oldkey, old) = self.bands.popitem(last = False)
+            self.bytes -= self.BitmapSize(old)
+
+
+    def BitmapSize(self, bitmap):
+        ## Rough memory use, assuming 32 bits per pixel
+        return bitmap.GetWidth() * bitmap.GetHeight() * 4
+
+
+    def GetStats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hitrate': lookups and float(self.hits) / lookups or 0.0,
+                'bands': len(self.bands),
+                'bytes': self.bytes,
+                'maxbytes': self.maxbytes}
 
 
-masklist = [0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01]
-
 
 class BitImage(wx.Window):
 
+    ## Images are rendered in bands of this many rows, cached by content
+    ## and shared between all windows
+    bandrows = 8
+    bandcache = BandCache()
+
     def __init__(self, parent):
         wx.Window.__init__(self, parent)
 
-        self.data = []
+        self.data = pclparse.raster()
+        self.page = None
         self.InitBuffer()
         
         self.Bind(wx.EVT_SIZE, self.OnSize)
@@ -74,27 +135,101 @@ class BitImage(wx.Window):
         return self.data
 
 
+    def GetStats(self):
+        return self.bandcache.GetStats()
+
+
     def SetData(self, newData):
+        ## Plain lists of rows are taken as monochrome data
+        if not isinstance(newData, pclparse.raster):
+            newData = pclparse.raster.fromrows(newData)
         self.data = newData
+        self.page = self.RenderPage()
         dc = wx.BufferedDC(wx.ClientDC(self), self.buffer)
         self.DrawImage(dc)
 
 
+    def RenderPage(self):
+        """
+        Returns a bitmap of the page put together from the band cache.
+        Only bands not seen before are rendered, planes are combined into
+        pixels thru the palette here.
+        """
+        width = self.data.width()
+        height = self.data.height()
+        if height == 0:
+            return None
+
+        page = wx.EmptyBitmap(width, height)
+        dc = wx.MemoryDC(page)
+        for first in range(0, height, self.bandrows):
+            last = min(first + self.bandrows, height)
+            key = self.data.digest(first, last)
+            bitmap = self.bandcache.Get(key)
+            if bitmap is None:
+                image = wx.ImageFromData(width, last - first,
+                                         self.data.rgb(first, last))
+                bitmap = wx.BitmapFromImage(image)
+                self.bandcache.Put(key, bitmap)
+            dc.DrawBitmap(bitmap, 0, first)
+        dc.SelectObject(wx.NullBitmap)
+        return page
+
+
     def DrawImage(self, dc):
         dc.SetBackground(wx.Brush("white"))
         dc.Clear()
 
-        dc.SetPen(wx.Pen("black", 1))
-        
-        if len(self.data) == 0:
-            return
-
-        for row, rowdata in enumerate(self.data):
-            for pos, posdata in enumerate(rowdata):
-                for bit, mask in enumerate(masklist):
-                    if mask & posdata:
-                        dc.DrawPoint(pos * 8 + bit, row + 0)
+        ## Resizing only blits the page, leaving the band cache alone
+        if self.page is not None:
+            dc.DrawBitmap(self.page, 0, 0)
 
 
 ## Test vector with data to insert into SetData
 testvector = [[0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff], [0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff],[0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff],[0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff],[0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff], [0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00], [0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00], [0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00], [0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00], [0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00],[0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00], [0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00, 0xff, 0x00]]
+
+
+if __name__ == '__main__':
+
+    ## Timing of SetData on repeated captures of the same screen where
+    ## only some rows change, as when the trace moves. Whole page is the
+    ## page rendered as one band without cache, like before the bands.
+    import time
+    import random
+    import serialrx
+
+    app = wx.App(0)
+    frame = wx.Frame(None, -1, 'BitImage', size = (700, 520))
+    window = BitImage(frame)
+    frame.Show()
+
+    fd = open('../samples/HP-E8285A/spectruma.txt', 'rb')
+    base = serialrx.pages(fd.read())[0]
+    fd.close()
+    rows = [bytearray(base.row(row)) for row in range(base.height())]
+
+    def capture(changed):
+        new = [bytearray(row) for row in rows]
+        for row in random.sample(range(len(new)), changed):
+            new[row][random.randrange(len(new[row]))] ^= 0x10
+        return pclparse.raster.fromrows(new)
+
+    for changed in [0, 1, 5, 20]:
+        captures = [capture(changed) for n in range(20)]
+        results = []
+        for bandrows in [base.height(), 32, 16, 8, 4]:
+            window.bandrows = bandrows
+            window.bandcache = BandCache()
+            window.SetData(base)
+            start = time.time()
+            for image in captures:
+                if bandrows == base.height():
+                    window.bandcache = BandCache()
+                window.SetData(image)
+            elapsed = (time.time() - start) / len(captures)
+            results.append('%s %.2f ms' % (bandrows == base.height() and
+                                           'whole page' or
+                                           '%d rows' % bandrows,
+                                           elapsed * 1000))
+        print("%2d rows changed: %s" % (changed, ', '.join(results)))
+    frame.Destroy()
@@ -34,30 +34,228 @@
 #
 
 import re
+import struct
+import hashlib
+
+
+## Pixel index lookup: bit n of a packed byte ends up as the value 0 or 1
+## in byte n of a 64 bit word, so that struct.pack('>Q') gives the eight
+## pixels left to right. Planes are merged by shifting the word up by the
+## plane number before or:ing them together.
+spread = [sum([((b >> n) & 1) << (8 * n) for n in range(8)])
+          for b in range(256)]
+
+
+## Most planes per row that can be merged thru spread, which also keeps
+## palettes within the 256 entries of 8 bit PNG and BMP images
+maxplanes = 8
+
+
+def validplanes(planes):
+    """
+    Returns True for plane settings (ESC*r#U) that can be handled, that
+    is the simple colour palettes and up to maxplanes grey planes.
+    """
+    return planes in (3, -3, -4) or 1 <= abs(planes) <= maxplanes
+
+
+def palette(planes):
+    """
+    Returns the lookup table mapping a pixel index to an (r, g, b) tuple
+    for the given plane setting as sent with ESC*r#U. The first plane
+    sent is the least significant bit of the index.
+    """
+    if not validplanes(planes):
+        raise ValueError('Unsupported number of planes %d' % planes)
+    if planes == 1:
+        ## Monochrome, black on white
+        return [(255, 255, 255), (0, 0, 0)]
+    elif planes == 3:
+        ## Simple colour RGB palette
+        return [(255 * (i & 1), 255 * ((i >> 1) & 1), 255 * ((i >> 2) & 1))
+                for i in range(8)]
+    elif planes == -3:
+        ## Simple colour CMY palette
+        return [(255 * (1 - (i & 1)), 255 * (1 - ((i >> 1) & 1)),
+                 255 * (1 - ((i >> 2) & 1))) for i in range(8)]
+    elif planes == -4:
+        ## Simple colour KCMY palette, black plane overrides the others
+        cmy = palette(-3)
+        return [(i & 1) and (0, 0, 0) or cmy[i >> 1] for i in range(16)]
+    else:
+        ## Unknown setting, use a grey ramp from white to black
+        last = (1 << abs(planes)) - 1
+        return [(255 - 255 * i // last,) * 3 for i in range(last + 1)]
+
+
+class raster:
+    """
+    Planar raster image. Each plane is stored packed, eight pixels per
+    byte, in one contiguous bytearray with all rows of the same length
+    (stride). Planes are combined into pixels thru the palette only when
+    asked for by indexed() or rgb().
+    """
+
+    def __init__(self, planes = 1):
+        self.planes = planes
+        self.palette = palette(planes)
+        self.data = [bytearray() for plane in range(abs(planes))]
+        self.stride = 0
+        self.rows = 0
+
+
+    @classmethod
+    def fromrows(cls, rows):
+        """
+        Returns a monochrome raster built from a list of rows, where
+        each row is a list of packed bytes.
+        """
+        image = cls()
+        for row in rows:
+            image.addrow([bytearray(row)])
+        return image
+
+
+    def width(self):
+        """
+        Returns the width of the image in pixels.
+        """
+        return self.stride * 8
+
+
+    def height(self):
+        """
+        Returns the height of the image in pixels.
+        """
+        return self.rows
+
+
+    def restride(self, stride):
+        """
+        Repacks all planes to a new, larger, row length.
+        """
+        for plane, old in enumerate(self.data):
+            new = bytearray(stride * self.rows)
+            for row in range(self.rows):
+                new[row * stride:row * stride + self.stride] = \
+                    old[row * self.stride:(row + 1) * self.stride]
+            self.data[plane] = new
+        self.stride = stride
+
+
+    def addrow(self, planedata):
+        """
+        Appends one row given as a list of packed data, one entry per
+        plane. Missing planes are left blank and surplus ones dropped.
+        Short rows are zero filled to the stride of the image.
+        """
+        planedata = planedata[:len(self.data)]
+        longest = max([len(data) for data in planedata] + [0])
+        if longest > self.stride:
+            self.restride(longest)
+        for plane, data in enumerate(planedata):
+            self.data[plane].extend(data)
+            self.data[plane].extend(bytearray(self.stride - len(data)))
+        for plane in range(len(planedata), len(self.data)):
+            self.data[plane].extend(bytearray(self.stride))
+        self.rows += 1
+
+
+    def row(self, row, plane = 0):
+        """
+        Returns the packed data of one row in one plane.
+        """
+        return self.data[plane][row * self.stride:(row + 1) * self.stride]
+
+
+    def digest(self, first = 0, last = None):
+        """
+        Returns a hash of the packed data of all planes in the rows first
+        up to, but not including, last. Bands with equal digests render
+        to equal pixels.
+        """
+        if last is None:
+            last = self.rows
+        md5 = hashlib.md5('%d:%d:%d' % (self.planes, self.stride,
+                                        last - first))
+        for data in self.data:
+            md5.update(data[first * self.stride:last * self.stride])
+        return md5.digest()
+
+
+    def indexed(self, first = 0, last = None):
+        """
+        Returns a bytearray with one palette index per pixel for the
+        rows first up to, but not including, last.
+        """
+        if last is None:
+            last = self.rows
+        start = first * self.stride
+        end = last * self.stride
+        if len(self.data) == 1:
+            words = [spread[b] for b in self.data[0][start:end]]
+        else:
+            words = [0] * (end - start)
+            for plane, data in enumerate(self.data):
+                for pos, b in enumerate(data[start:end]):
+                    words[pos] |= spread[b] << plane
+        return bytearray(struct.pack('>%dQ' % len(words), *words))
+
+
+    def rgb(self, first = 0, last = None):
+        """
+        Returns the rows first up to, but not including, last as a
+        string of RGB triplets, as wanted by wx.ImageFromData.
+        """
+        indices = self.indexed(first, last)
+        out = bytearray(len(indices) * 3)
+        for channel in range(3):
+            table = bytearray(256)
+            for index, colour in enumerate(self.palette):
+                table[index] = colour[channel]
+            out[channel::3] = indices.translate(bytes(table))
+        return bytes(out)
+
 
 class pclparse:
 
     def __init__(self):
-        self.data = []
         self.string = ''
-        self.pclre = re.compile('((\033[*\&][tkrb])(\d*)([WRAB]))')
+        self.pclre = re.compile('((\033[*\&][tkrb])(-?\d*)([WRABUV]))')
         self.state = 'STATE_IDLE'
         self.row = 0
         self.rowlen = 0
+        self.planes = 1
+        self.lastplane = True
+        self.clear()
+
+
+    def clear(self):
+        """
+        Drops the parsed image and starts over with an empty one.
+        """
+        self.image = raster(self.planes)
+        self.planedata = []
 
 
     def width(self):
         """
         Returns the width of the image in pixels.
         """
-        return len(self.data[0]) * 8
+        return self.image.width()
 
 
     def height(self):
         """
         Returns the height of the image in pixels.
         """
-        return len(self.data)
+        return self.image.height()
+
+
+    def endrow(self):
+        if len(self.planedata) > 0:
+            self.image.addrow(self.planedata)
+            self.planedata = []
 
 
     def parse(self, string):
@@ -68,11 +266,12 @@ class pclparse:
             done = True
             if self.state ==  'STATE_GRAPHICS_DATA' and \
               len(self.string) >= self.rowlen:
-                data = map(ord, list(self.string[0:self.rowlen]))
-                self.data.append(data)
+                self.planedata.append(bytearray(self.string[0:self.rowlen]))
                 self.string = self.string[self.rowlen:]
                 done = False
                 self.state = 'STATE_GRAPHICS'
+                if self.lastplane:
+                    self.endrow()
 
             hits = re.search(self.pclre, self.string)
             if hits:
@@ -84,11 +283,28 @@ class pclparse:
                     self.state = 'STATE_GRAPHICS'
                 elif txtblk == '\033*rB':
                     # print 'End Graphics'
+                    self.endrow()
                     self.state = 'STATE_IDLE'
-                elif self.state == 'STATE_GRAPHICS' and txtblk == '\033*bW':
+                elif txtblk == '\033*rU':
+                    # print 'Number of planes'
+                    try:
+                        planes = int(hits.groups()[2] or 1)
+                    except ValueError:
+                        ## Lone sign, ignore
+                        planes = 0
+                    if validplanes(planes):
+                        self.planes = planes
+                        if self.image.height() == 0:
+                            self.clear()
+                elif self.state == 'STATE_GRAPHICS' and \
+                  txtblk in ('\033*bV', '\033*bW'):
                     # print 'Graphics Data'
                     self.state = 'STATE_GRAPHICS_DATA'
-                    self.rowlen = int(hits.groups()[2])
+                    ## Only plane setting is signed, a signed or missing
+                    ## length is taken as an empty row
+                    value = hits.groups()[2]
+                    self.rowlen = value.isdigit() and int(value) or 0
+                    self.lastplane = txtblk == '\033*bW'
                 elif len(txtblk) > 0 and txtblk[0] == '\033':
                     # print 'Unhandled %s' % (txtblk[1:])
                     pass
@@ -121,3 +337,13 @@ if __name__ == '__main__':
     fd.close()
 
     print("Image size (8752A): %dx%d" %  (pcl.width(), pcl.height()))
+
+    ## Test of parser (three CMY planes per row)
+    pcl = pclparse()
+    pcl.parse('\033*r-3U\033*rA')
+    for row in range(4):
+        pcl.parse('\033*b2V\xf0\x00\033*b2V\x0f\x00\033*b2W\x00\xff')
+    pcl.parse('\033*rB')
+    print("Image size (CMY): %dx%d, %d planes" % (pcl.width(), pcl.height(),
+                                                  len(pcl.image.data)))
+    print("First row indices: %s" % list(pcl.image.indexed(0, 1)))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Receiving of PCL pages from a serial port, kept free from wx so it can
+# be used both by the GUI and by tools running without one.
+#
+# Copyright (c) 2010-2012, Ciellt/Stefan Petersen (spe@ciellt.se)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the author nor the names of any contributors
+#    may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import threading
+import pclparse
+
+
+class serialreader:
+    """
+    Thread that reads from an open serial port and hands everything
+    received to callback.
+    """
+
+    def __init__(self, ser, callback):
+        self.ser = ser
+        self.callback = callback
+        self.thread = None
+        self.alive = threading.Event()
+
+
+    def start(self):
+        """Start the receiver thread"""
+        self.thread = threading.Thread(target = self.run)
+        self.thread.setDaemon(1)
+        self.alive.set()
+        self.thread.start()
+
+
+    def stop(self):
+        """Stop the receiver thread, wait util it's finished."""
+        if self.thread is not None:
+            self.alive.clear()          #clear alive event for thread
+            self.thread.join()          #wait until thread has finished
+            self.thread = None
+
+
+    def run(self):
+        while self.alive.isSet():               #loop while alive event is true
+            text = self.ser.read(1)          #read one, with timeout
+            if text:                            #check if not timeout
+                n = self.ser.inWaiting()     #look if there is more to read
+                if n:
+                    text = text + self.ser.read(n) #get it
+                self.callback(text)
+
+
+class pagereceiver:
+    """
+    Splits a stream of received PCL data into pages. A page starts when
+    the parser leaves idle and is done when it is back in idle.
+    """
+
+    def __init__(self):
+        self.pcl = pclparse.pclparse()
+        self.streaming = False
+
+
+    def height(self):
+        """
+        Returns the number of rows received of the current page.
+        """
+        return self.pcl.height()
+
+
+    def receive(self, data):
+        """
+        Parses received data. Returns the page if data completed one,
+        otherwise None. streaming is True while a page is received.
+        """
+        self.pcl.parse(data)
+
+        # Found start of graphical block
+        if not self.streaming and self.pcl.state != 'STATE_IDLE':
+            self.streaming = True
+
+        # Found end of graphical block
+        if self.streaming and self.pcl.state == 'STATE_IDLE':
+            self.streaming = False
+            image = self.pcl.image
+            self.pcl.clear()
+            return image
+        return None
+
+
+    def abort(self):
+        """
+        Drops the page being received.
+        """
+        self.pcl.state = 'STATE_IDLE'
+        self.streaming = False
+        self.pcl.clear()
+
+
+def pages(data, chunk = 100):
+    """
+    Returns all pages in data, parsed chunk bytes at a time.
+    """
+    receiver = pagereceiver()
+    images = []
+    for pos in range(0, len(data), chunk):
+        image = receiver.receive(data[pos:pos + chunk])
+        if image is not None:
+            images.append(image)
+    return images
+
+
+if __name__ == '__main__':
+
+    ## Test of page splitting, the same dump twice in a row
+    fd = open('../samples/HP-E8285A/rx-test.txt', 'rb')
+    data = fd.read()
+    fd.close()
+    images = pages(data + data)
+    print("Pages: %d, %s" % (len(images),
+                             ['%dx%d' % (image.width(), image.height())
+                              for image in images]))
@@ -36,18 +36,31 @@
 #
 
 import wx
+import optparse
 import tivuMain
 
 class TivuApp(wx.App):
+    def __init__(self, redirect, options):
+        self.options = options
+        wx.App.__init__(self, redirect)
+
     def OnInit(self):
         wx.InitAllImageHandlers()
         frame_1 = tivuMain.TivuFrame(None, -1, "")
         self.SetTopWindow(frame_1)
         frame_1.Show()
+        if self.options.http:
+            frame_1.StartWebViewer(self.options.http)
         return 1
 
 # end of class MyApp
 
 if __name__ == "__main__":
-    app = TivuApp(0)
+    parser = optparse.OptionParser()
+    parser.add_option('--http', metavar = '[HOST:]PORT',
+                      help = 'serve captures to web browsers on HOST:PORT, '
+                             'HOST defaults to localhost')
+    (options, args) = parser.parse_args()
+
+    app = TivuApp(0, options)
     app.MainLoop()
@@ -38,11 +38,13 @@
 import wx
 import os
 import glob
-import threading
+import socket
 import serial
 import tivuGUI
 import bitimage
 import pclparse
+import serialrx
+import tivuweb
 
 
 #----------------------------------------------------------------------
@@ -75,12 +77,10 @@ class TivuFrame(tivuGUI.MainFrame):
         self.ser = None
         self.speed = 9600
 
-        self.pcl = pclparse.pclparse()
-        self.streaming = False
+        self.receiver = serialrx.pagereceiver()
         
         ## Thread specific variables
         self.thread = None
-        self.alive = threading.Event()
 
         ## Bind residual events
         self.Bind(EVT_SERIALRX, self.OnSerialRead)
@@ -89,6 +89,9 @@ class TivuFrame(tivuGUI.MainFrame):
         self.gauge = 0
         self.gaugemeter = None
 
+        ## Optional web viewer
+        self.web = None
+
         
     def OnNew(self, event):
         self.BitWindow.SetData([])
@@ -113,7 +116,7 @@ class TivuFrame(tivuGUI.MainFrame):
         fd.close()
 
         ## Blit the parsed data to the bit window
-        self.BitWindow.SetData(pcl.data)
+        self.PageDone(pcl.image)
 
 
     defaultFile = 'Image'
@@ -202,43 +205,50 @@ class TivuFrame(tivuGUI.MainFrame):
         dlg.Destroy()
 
         if modal == wx.ID_OK:
-            # If serial port is open we must close it and make sure serial
-            # receiving thread is stopped.
-            if self.ser and self.ser.isOpen():
-                self.StopThread()
-                self.ser.close()
-                self.ser = None
-                self.statusbar.SetStatusText('No Comport', 1)
-                
-            ## Open serial port with requested speed
-            try:
-                self.ser = serial.Serial(serialport, self.speed, timeout = 1)
-            except:
-                wx.MessageBox("Serial port %s is not available" % serialport,
-                              "Open serial port",
-                              style = wx.OK | wx.ICON_ERROR)
-                return
-
-            ## Check if we managed to open port. At least in Linux it seems
-            ## that sometimes serial.Serial does not generate an exception
-            ## despite port is not opened.
-            if not self.ser or not self.ser.isOpen():
-                wx.MessageBox("Serial port %s failed to open" % serialport,
-                              "Open serial port",
-                              style = wx.OK | wx.ICON_ERROR)
-                return
-
-            ## Update statusbar
-            self.statusbar.SetStatusText('%s' % serialport, 1)
-
-            ## Start receiving thread
-            self.StartThread()
+            self.OpenPort(serialport)
+
+
+    def OpenPort(self, serialport):
+        """Open serial port and start receiving from it"""
+        # If serial port is open we must close it and make sure serial
+        # receiving thread is stopped.
+        if self.ser and self.ser.isOpen():
+            self.StopThread()
+            self.ser.close()
+            self.ser = None
+            self.statusbar.SetStatusText('No Comport', 1)
+
+        ## Open serial port with requested speed
+        try:
+            self.ser = serial.Serial(serialport, self.speed, timeout = 1)
+        except:
+            wx.MessageBox("Serial port %s is not available" % serialport,
+                          "Open serial port",
+                          style = wx.OK | wx.ICON_ERROR)
+            return False
+
+        ## Check if we managed to open port. At least in Linux it seems
+        ## that sometimes serial.Serial does not generate an exception
+        ## despite port is not opened.
+        if not self.ser or not self.ser.isOpen():
+            wx.MessageBox("Serial port %s failed to open" % serialport,
+                          "Open serial port",
+                          style = wx.OK | wx.ICON_ERROR)
+            return False
+
+        ## Update statusbar
+        self.statusbar.SetStatusText('%s' % serialport, 1)
+
+        ## Start receiving thread
+        self.StartThread()
+        return True
 
 
     def OnSerialPortSpeed(self, event):
         dlg = wx.SingleChoiceDialog(None, "Select Speed", "Speed",
                                     ['300','600','1200','2400','4800','9600',
-                                     '19200','38400','57600'])
+                                     '19200','38400','57600','115200',
+                                     '230400'])
         modal = dlg.ShowModal()
         speedstring = dlg.GetStringSelection()
         dlg.Destroy()
@@ -255,12 +265,10 @@ class TivuFrame(tivuGUI.MainFrame):
 
 
     def OnSerialRead(self, event):
-        data = event.data
-        self.pcl.parse(data)
+        image = self.receiver.receive(event.data)
 
         # Found start of graphical block
-        if self.streaming == False and self.pcl.state != 'STATE_IDLE':
-            self.streaming = True
+        if self.receiver.streaming and self.gaugemeter is None:
             self.gauge = 0
             self.gaugemeter = wx.ProgressDialog('Receiving Data',
                                                 'Receiving data from instrument...',
@@ -269,54 +277,71 @@ class TivuFrame(tivuGUI.MainFrame):
                                                         wx.PD_CAN_ABORT)
 
         # Receiving graphical datablock
-        if self.streaming and len(self.pcl.data) > self.gauge:
-            self.gauge = len(self.pcl.data)
+        if self.receiver.streaming and self.receiver.height() > self.gauge:
+            self.gauge = self.receiver.height()
             (cont, skip) = self.gaugemeter.Update(self.gauge)
             wx.SafeYield()
             if not cont:
-                self.pcl.state = 'STATE_IDLE'
-                self.streaming = False
-                self.pcl.data = []
+                self.receiver.abort()
                 self.gaugemeter.Destroy()
                 self.gaugemeter = None
             
         # Found end of graphical block
-        if self.streaming and self.pcl.state == 'STATE_IDLE':
-            self.streaming = False
-            self.BitWindow.SetData(self.pcl.data)
-            self.pcl.data = []
-            wx.MilliSleep(100)
-            self.gaugemeter.Destroy()
-            self.gaugemeter = None
+        if image is not None:
+            self.PageDone(image)
+            if self.gaugemeter:
+                wx.MilliSleep(100)
+                self.gaugemeter.Destroy()
+                self.gaugemeter = None
+
+
+    def PageDone(self, image):
+        """Show a completely received page"""
+        self.BitWindow.SetData(image)
+        self.ShowStats()
+        if self.web:
+            self.web.add(image)
+
+
+    def StartWebViewer(self, address):
+        """Start the web viewer on [host:]port"""
+        (host, sep, port) = address.rpartition(':')
+        try:
+            self.web = tivuweb.webviewer(host or 'localhost', int(port))
+        except (ValueError, socket.error):
+            wx.MessageBox("Web viewer could not be started on %s" % address,
+                          "Web viewer",
+                          style = wx.OK | wx.ICON_ERROR)
+            return
+        self.web.addstats('bandcache', self.BitWindow.GetStats)
+        self.web.start()
+
+
+    def ShowStats(self):
+        """Show band cache statistics in the statusbar"""
+        stats = self.BitWindow.GetStats()
+        self.statusbar.SetStatusText('Band cache: %d%% hits, %d kB'
+                                     % (stats['hitrate'] * 100,
+                                        stats['bytes'] / 1024), 3)
 
 
     def StartThread(self):
         """Start the receiver thread"""
-        self.thread = threading.Thread(target = self.ComPortThread)
-        self.thread.setDaemon(1)
-        self.alive.set()
+        self.thread = serialrx.serialreader(self.ser, self.PostSerialRx)
         self.thread.start()
 
 
     def StopThread(self):
         """Stop the receiver thread, wait util it's finished."""
         if self.thread is not None:
-            self.alive.clear()          #clear alive event for thread
-            self.thread.join()          #wait until thread has finished
+            self.thread.stop()
             self.thread = None
 
 
-    def ComPortThread(self):
-        """Thread that handles the incoming traffic. Generates an
-           SerialRxEvent"""
-        while self.alive.isSet():               #loop while alive event is true
-            text = self.ser.read(1)          #read one, with timeout
-            if text:                            #check if not timeout
-                n = self.ser.inWaiting()     #look if there is more to read
-                if n:
-                    text = text + self.ser.read(n) #get it
-                event = SerialRxEvent(self.GetId(), text)
-                self.GetEventHandler().AddPendingEvent(event)
+    def PostSerialRx(self, text):
+        """Called from the receiver thread. Generates an SerialRxEvent"""
+        event = SerialRxEvent(self.GetId(), text)
+        self.GetEventHandler().AddPendingEvent(event)
 
                 
     def OnAbout(self, event):
@@ -374,5 +399,7 @@ POSSIBILITY OF SUCH DAMAGE.
 
     def OnQuit(self, event):
         self.StopThread()
+        if self.web:
+            self.web.stop()
         self.Destroy()
         
@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Replay of dumped printouts thru a pseudo terminal, to test the serial
+# capture path without an instrument. A child process streams a dump
+# into the master side at the selected baud rate while tivu, headless or
+# with the GUI, reads the slave side. End-to-end latency, lost or
+# corrupted data and CPU use are reported per job.
+#
+# Copyright (c) 2010-2012, Ciellt/Stefan Petersen (spe@ciellt.se)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the author nor the names of any contributors
+#    may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import pty
+import tty
+import sys
+import time
+import Queue
+import errno
+import fcntl
+import random
+import optparse
+import resource
+import serial
+import serialrx
+
+
+#----------------------------------------------------------------------
+# Feeder side, run in a child process so its CPU time is not counted
+# as capture time.
+
+def pageends(data):
+    """
+    Feeds data one byte at a time thru the same page detection as the
+    capture path. Returns (ends, pages), the offset of the byte that
+    completed each page and the pages themselves.
+    """
+    receiver = serialrx.pagereceiver()
+    ends = []
+    images = []
+    for pos in range(len(data)):
+        image = receiver.receive(data[pos])
+        if image is not None:
+            ends.append(pos)
+            images.append(image)
+    return (ends, images)
+
+
+def feed(fd, report, data, ends, options):
+    """
+    Writes the options.repeat copies of the dump in data to the pty
+    master fd, paced as a serial line at options.baud with 8N1 framing,
+    with options.gap between the copies. Each chunk has a scheduled time
+    and optional jitter is added on top of it without accumulating.
+    Bytes that do not fit in the pty buffer are dropped like a receiver
+    overrun. Write time of the byte completing every page, at offsets
+    ends, is reported.
+    """
+    bytetime = 10.0 / options.baud
+    chunk = max(1, options.baud / 10 / 1000)
+    dumplen = len(data) / options.repeat
+    stops = sorted(set(ends + [dumplen * (job + 1) - 1
+                               for job in range(options.repeat)]))
+    pageset = set(ends)
+
+    due = time.time()
+    last = due
+    sinceburst = 0
+    pos = 0
+    page = 0
+    overrun = 0
+    for end in stops:
+        while pos <= end:
+            size = min(chunk, end + 1 - pos)
+            if options.burst:
+                size = min(size, options.burst - sinceburst)
+
+            ## Wait for the scheduled time of this chunk
+            when = max(last, due + random.uniform(0, options.jitter))
+            delay = when - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            last = when
+
+            try:
+                written = os.write(fd, data[pos:pos + size])
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                written = 0
+            overrun += size - written
+            pos += size
+            due += size * bytetime
+
+            if options.burst:
+                sinceburst += size
+                if sinceburst >= options.burst:
+                    sinceburst = 0
+                    due += options.burstgap
+
+        if end in pageset:
+            os.write(report, 'page %d %f %d\n' % (page, time.time(),
+                                                  overrun))
+            page += 1
+            overrun = 0
+
+        if (end + 1) % dumplen == 0:
+            due += options.gap
+    os.write(report, 'done %f\n' % time.time())
+
+
+def startfeeder(data, ends, options):
+    """
+    Opens a pty pair and forks the feeder. Returns (pid, slave name,
+    slave fd, go fd, report fd). The feeder waits for a byte on the go
+    pipe before it starts and keeps the master open until go is closed.
+    """
+    (master, slave) = pty.openpty()
+    tty.setraw(slave)
+    name = os.ttyname(slave)
+    (gor, gow) = os.pipe()
+    (reportr, reportw) = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        os.close(slave)
+        os.close(gow)
+        os.close(reportr)
+        tty.setraw(master)
+        fl = fcntl.fcntl(master, fcntl.F_GETFL)
+        fcntl.fcntl(master, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        ## End of file instead of go means the capture side failed
+        if not os.read(gor, 1):
+            os._exit(1)
+        try:
+            feed(master, reportw, data, ends, options)
+            ## Keep the line up until the capture side is done
+            os.read(gor, 1)
+        finally:
+            os._exit(0)
+
+    os.close(master)
+    os.close(gor)
+    os.close(reportw)
+    return (pid, name, slave, gow, reportr)
+
+
+#----------------------------------------------------------------------
+# Capture side
+
+def cputime():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class capturelog:
+    """
+    Records time, CPU use and received bytes for every finished page.
+    Bytes are counted per read, so data following the end of a page in
+    the same read is counted to that page.
+    """
+
+    def __init__(self):
+        self.pages = []
+        self.start()
+
+
+    def start(self):
+        self.received = 0
+        self.lastrx = time.time()
+        self.cpu = cputime()
+
+
+    def rx(self, data):
+        self.received += len(data)
+        self.lastrx = time.time()
+
+
+    def page(self, image):
+        now = time.time()
+        cpu = cputime()
+        self.pages.append({'time': now,
+                           'cpu': cpu - self.cpu,
+                           'received': self.received,
+                           'image': image})
+        self.received = 0
+        self.cpu = cpu
+
+
+def headless(port, options, pages, log, ready):
+    """
+    Runs the capture path without GUI: the same serialreader and
+    pagereceiver as TivuFrame, with a queue in place of SerialRxEvent.
+    """
+    ser = serial.Serial(port, options.baud, timeout = 1)
+    events = Queue.Queue()
+    reader = serialrx.serialreader(ser, events.put)
+    reader.start()
+    ready()
+
+    receiver = serialrx.pagereceiver()
+    try:
+        while len(log.pages) < pages and \
+                time.time() - log.lastrx < options.timeout:
+            try:
+                data = events.get(timeout = 0.1)
+            except Queue.Empty:
+                continue
+            log.rx(data)
+            image = receiver.receive(data)
+            if image is not None:
+                log.page(image)
+    finally:
+        reader.stop()
+        ser.close()
+
+
+def gui(port, options, pages, log, ready):
+    """
+    Runs the capture path in the real tivu frame.
+    """
+    import wx
+    import tivuMain
+
+    class ReplayFrame(tivuMain.TivuFrame):
+
+        def OnSerialRead(self, event):
+            log.rx(event.data)
+            tivuMain.TivuFrame.OnSerialRead(self, event)
+
+
+        def PageDone(self, image):
+            tivuMain.TivuFrame.PageDone(self, image)
+            log.page(image)
+            if len(log.pages) >= pages:
+                wx.CallAfter(self.Close)
+
+
+        def OnTimer(self, event):
+            if time.time() - log.lastrx > options.timeout:
+                self.Close()
+
+    class ReplayApp(wx.App):
+        def OnInit(self):
+            wx.InitAllImageHandlers()
+            frame = ReplayFrame(None, -1, "")
+            frame.speed = options.baud
+            self.SetTopWindow(frame)
+            frame.Show()
+            frame.timer = wx.Timer(frame)
+            frame.Bind(wx.EVT_TIMER, frame.OnTimer, frame.timer)
+            frame.timer.Start(500)
+            if not frame.OpenPort(port):
+                return False
+            ready()
+            return True
+
+    app = ReplayApp(0)
+    app.MainLoop()
+
+
+#----------------------------------------------------------------------
+
+def badrows(image, ref):
+    """
+    Returns the number of rows in image that differ from ref.
+    """
+    if image.width() != ref.width() or image.planes != ref.planes:
+        return max(image.height(), ref.height())
+    bad = abs(image.height() - ref.height())
+    for row in range(min(image.height(), ref.height())):
+        for plane in range(len(ref.data)):
+            if image.row(row, plane) != ref.row(row, plane):
+                bad += 1
+                break
+    return bad
+
+
+def replay(filename, options):
+    fd = open(filename, 'rb')
+    data = fd.read()
+    fd.close()
+    stream = data * options.repeat
+    (ends, refs) = pageends(stream)
+    if not refs:
+        print("No pages found in %s" % filename)
+        return 1
+    pages = len(refs)
+
+    (pid, port, slave, go, report) = startfeeder(stream, ends, options)
+    log = capturelog()
+
+    def ready():
+        ## Port is open, start feeding
+        log.start()
+        os.write(go, 'g')
+
+    try:
+        if options.gui:
+            gui(port, options, pages, log, ready)
+        else:
+            headless(port, options, pages, log, ready)
+    finally:
+        ## Stop the feeder and collect its report
+        os.close(go)
+        lines = os.fdopen(report).read().splitlines()
+        os.waitpid(pid, 0)
+        os.close(slave)
+
+    written = []
+    for line in lines:
+        fields = line.split()
+        if fields[0] == 'page':
+            written.append((float(fields[2]), int(fields[3])))
+
+    ## Bytes sent per page, counted from the end of the page before
+    sizes = [b - a for (a, b) in zip([-1] + ends[:-1], ends)]
+
+    print("%s at %d baud, %d pages" % (filename, options.baud, pages))
+    print("%4s %8s %8s %8s %9s %10s %8s" % ('job', 'sent', 'received',
+                                            'overrun', 'bad rows',
+                                            'latency ms', 'cpu ms'))
+    latencies = []
+    failed = False
+    for job in range(pages):
+        sent = sizes[job]
+        if job < len(written):
+            (wtime, overrun) = written[job]
+        else:
+            (wtime, overrun) = (None, 0)
+        if job < len(log.pages):
+            page = log.pages[job]
+            bad = badrows(page['image'], refs[job])
+            failed = failed or bad > 0 or overrun > 0
+            if wtime is not None:
+                latency = (page['time'] - wtime) * 1000
+                latencies.append(latency)
+                latency = '%.1f' % latency
+            else:
+                latency = '-'
+            print("%4d %8d %8d %8d %9d %10s %8.1f"
+                  % (job, sent, page['received'], overrun, bad, latency,
+                     page['cpu'] * 1000))
+        else:
+            failed = True
+            print("%4d %8d %8s %8d %9s %10s %8s"
+                  % (job, sent, '-', overrun, 'lost', '-', '-'))
+
+    if latencies:
+        latencies.sort()
+        print("latency ms: min %.1f, median %.1f, max %.1f"
+              % (latencies[0], latencies[len(latencies) / 2],
+                 latencies[-1]))
+    return failed and 1 or 0
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage = '%prog [options] DUMP')
+    parser.add_option('-b', '--baud', type = 'int', default = 9600,
+                      help = 'line speed, default %default')
+    parser.add_option('-n', '--repeat', type = 'int', default = 1,
+                      help = 'number of times to send the dump')
+    parser.add_option('--gap', type = 'float', default = 0.5,
+                      help = 'idle seconds between jobs, default %default')
+    parser.add_option('--jitter', type = 'float', default = 0.0,
+                      help = 'max random delay in ms added to each chunk')
+    parser.add_option('--burst', metavar = 'BYTES:MS', default = '',
+                      help = 'pause MS ms after every BYTES bytes')
+    parser.add_option('--timeout', type = 'float', default = 5.0,
+                      help = 'give up after this many seconds without '
+                             'data, default %default')
+    parser.add_option('--gui', action = 'store_true', default = False,
+                      help = 'capture with the tivu GUI instead of headless')
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('one dump file expected')
+
+    options.jitter /= 1000.0
+    if options.burst:
+        (burst, gap) = options.burst.split(':')
+        options.burst = int(burst)
+        options.burstgap = float(gap) / 1000.0
+    else:
+        options.burst = 0
+
+    sys.exit(replay(args[0], options))
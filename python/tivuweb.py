@@ -0,0 +1,562 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+# Small embedded HTTP server that lets a web browser look at the latest
+# and earlier captures. New captures are pushed to the browsers with
+# server-sent events.
+#
+# Copyright (c) 2010-2012, Ciellt/Stefan Petersen (spe@ciellt.se)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the author nor the names of any contributors
+#    may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+import re
+import json
+import time
+import zlib
+import socket
+import struct
+import urlparse
+import threading
+import collections
+import SocketServer
+import BaseHTTPServer
+
+
+def scalerows(image, scale):
+    """
+    Yields the palette indices of the image row by row, enlarged scale
+    times in both directions.
+    """
+    width = image.width()
+    for row in range(image.height()):
+        indices = image.indexed(row, row + 1)
+        if scale > 1:
+            scaled = bytearray(width * scale)
+            for n in range(scale):
+                scaled[n::scale] = indices
+            indices = scaled
+        for n in range(scale):
+            yield indices
+
+
+def pngchunk(tag, data):
+    chunk = tag + data
+    return ''.join([struct.pack('>I', len(data)), chunk,
+                    struct.pack('>I', zlib.crc32(chunk) & 0xffffffff)])
+
+
+def encodepng(image, scale):
+    """
+    Encodes the image as a palette based PNG.
+    """
+    raw = bytearray()
+    for indices in scalerows(image, scale):
+        raw.append(0)
+        raw.extend(indices)
+    header = struct.pack('>IIBBBBB', image.width() * scale,
+                         image.height() * scale, 8, 3, 0, 0, 0)
+    palette = ''.join([struct.pack('BBB', *colour)
+                       for colour in image.palette])
+    return ''.join(['\x89PNG\r\n\x1a\n',
+                    pngchunk('IHDR', header),
+                    pngchunk('PLTE', palette),
+                    pngchunk('IDAT', zlib.compress(bytes(raw), 6)),
+                    pngchunk('IEND', '')])
+
+
+def encodebmp(image, scale):
+    """
+    Encodes the image as an 8 bit palette based BMP.
+    """
+    width = image.width() * scale
+    height = image.height() * scale
+    pad = bytearray(-width % 4)
+    rows = [bytes(indices + pad) for indices in scalerows(image, scale)]
+    ## BMP rows are stored bottom up
+    rows.reverse()
+    pixels = ''.join(rows)
+    palette = ''.join([struct.pack('BBBB', b, g, r, 0)
+                       for (r, g, b) in image.palette])
+    offset = 14 + 40 + len(palette)
+    return ''.join([struct.pack('<2sIHHI', 'BM', offset + len(pixels),
+                                0, 0, offset),
+                    struct.pack('<IiiHHIIiiII', 40, width, height, 1, 8, 0,
+                                len(pixels), 2835, 2835,
+                                len(image.palette), 0),
+                    palette, pixels])
+
+
+## Supported formats, their encoder and their content type
+encoders = {'png': (encodepng, 'image/png'),
+            'bmp': (encodebmp, 'image/bmp')}
+
+
+class encodecache:
+    """
+    Bounded LRU cache of encoded images, shared by all captures and keyed
+    by (capture number, format, scale).
+    """
+
+    def __init__(self, maxbytes = 32 * 1024 * 1024):
+        self.maxbytes = maxbytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+            return entry
+
+
+    def put(self, key, data):
+        """
+        Stores encoded data, dropping the least recently used entries
+        when the cache grows beyond maxbytes. Entries larger than the
+        whole cache are not stored.
+        """
+        if len(data) > self.maxbytes:
+            return
+        with self.lock:
+            self.entries[key] = data
+            self.bytes += len(data)
+            while self.bytes > self.maxbytes:
+                (oldkey, old) = self.entries.popitem(last = False)
+                self.bytes -= len(old)
+
+
+    def drop(self, number):
+        """
+        Removes all encodings of a capture.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == number]:
+                self.bytes -= len(self.entries.pop(key))
+
+
+class capture:
+    """
+    One finished page. The raster is never changed once published, so
+    every format and scale is encoded once and then kept in the cache,
+    as long as it fits.
+    """
+
+    def __init__(self, number, image, cache):
+        self.number = number
+        self.image = image
+        self.time = time.time()
+        self.cache = cache
+        self.digest = None
+        self.lock = threading.Lock()
+
+
+    def describe(self):
+        return {'id': self.number,
+                'time': self.time,
+                'width': self.image.width(),
+                'height': self.image.height(),
+                'planes': self.image.planes}
+
+
+    def etag(self, format, scale):
+        """
+        Returns the ETag of the capture in the given format and scale. It
+        is made from the raster data, so it is known without encoding.
+        """
+        with self.lock:
+            if self.digest is None:
+                self.digest = self.image.digest().encode('hex')
+            return '"%s-%s-%d"' % (self.digest, format, scale)
+
+
+    def encode(self, format, scale):
+        """
+        Returns (data, cached) for the capture in the given format and
+        scale. Concurrent requests for the same encoding wait for the
+        first one instead of encoding it again.
+        """
+        with self.lock:
+            key = (self.number, format, scale)
+            data = self.cache.get(key)
+            if data is not None:
+                return (data, True)
+            data = encoders[format][0](self.image, scale)
+            self.cache.put(key, data)
+            return (data, False)
+
+
+page = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Test Instrument Viewer</title>
+<style>
+body { font-family: sans-serif; }
+img { image-rendering: pixelated; border: 1px solid #888; }
+li { display: inline; margin-right: 0.5em; }
+</style>
+</head>
+<body>
+<h1>Test Instrument Viewer</h1>
+<p>Scale:
+<a href="?scale=1">1</a> <a href="?scale=2">2</a> <a href="?scale=3">3</a>
+| <span id="info">waiting for capture</span></p>
+<p><img id="image" alt=""></p>
+<ul id="history"></ul>
+<script>
+var scale = (/scale=(\\d+)/.exec(location.search) || [0, 1])[1];
+function show(capture) {
+  document.getElementById('image').src = '/' + capture.id + '.png?scale=' + scale;
+  document.getElementById('info').textContent = 'Capture ' + capture.id +
+    ', ' + new Date(capture.time * 1000).toLocaleString();
+}
+function add(capture) {
+  var li = document.createElement('li');
+  var a = document.createElement('a');
+  a.href = '#';
+  a.textContent = capture.id;
+  a.onclick = function() { show(capture); return false; };
+  li.appendChild(a);
+  document.getElementById('history').appendChild(li);
+}
+var xhr = new XMLHttpRequest();
+xhr.onload = function() {
+  var captures = JSON.parse(xhr.responseText);
+  captures.forEach(add);
+  if (captures.length) show(captures[captures.length - 1]);
+};
+xhr.open('GET', '/captures');
+xhr.send();
+new EventSource('/events').addEventListener('capture', function(e) {
+  var capture = JSON.parse(e.data);
+  add(capture);
+  show(capture);
+});
+</script>
+</body>
+</html>
+"""
+
+
+class viewerhandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    imagere = re.compile('^/(latest|\d+)\.(%s)$' % '|'.join(encoders))
+
+    def log_message(self, format, *args):
+        ## Keep quiet, tivu is normally run without a console
+        pass
+
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        viewer = self.server.viewer
+        viewer.count('requests')
+
+        hits = self.imagere.match(url.path)
+        if url.path == '/':
+            self.senddata(page, 'text/html; charset=utf-8')
+        elif url.path == '/captures':
+            self.senddata(json.dumps(viewer.describe()), 'application/json')
+        elif url.path == '/stats':
+            self.senddata(json.dumps(viewer.statistics()), 'application/json')
+        elif url.path == '/events':
+            self.sendevents()
+        elif hits:
+            try:
+                scale = int(query.get('scale', ['1'])[0])
+            except ValueError:
+                scale = 0
+            if scale < 1 or scale > viewer.maxscale:
+                self.send_error(400, 'Bad scale')
+                return
+            self.sendimage(hits.group(1), hits.group(2), scale)
+        else:
+            self.send_error(404)
+
+
+    def senddata(self, data, contenttype, headers = []):
+        self.send_response(200)
+        self.send_header('Content-Type', contenttype)
+        self.send_header('Content-Length', str(len(data)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def sendimage(self, which, format, scale):
+        ## Capture numbers start over when tivu is restarted, so browsers
+        ## must always revalidate. The ETag makes that cheap.
+        viewer = self.server.viewer
+        cachecontrol = 'no-cache'
+        if which == 'latest':
+            cap = viewer.get()
+        else:
+            cap = viewer.get(int(which))
+        if cap is None:
+            self.send_error(404, 'No such capture')
+            return
+
+        etag = cap.etag(format, scale)
+        if self.headers.get('If-None-Match') == etag:
+            viewer.count('notmodified')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', cachecontrol)
+            self.end_headers()
+            return
+
+        (data, cached) = cap.encode(format, scale)
+        viewer.count(cached and 'hits' or 'encodes')
+        self.senddata(data, encoders[format][1],
+                      [('ETag', etag), ('Cache-Control', cachecontrol)])
+
+
+    def sendevents(self):
+        ## Event ids are run:number, capture numbers start over when tivu
+        ## is restarted. A browser that saw an earlier run has seen none
+        ## of the captures of this one.
+        viewer = self.server.viewer
+        (run, sep, number) = self.headers.get('Last-Event-ID', '').partition(':')
+        if not sep:
+            last = viewer.latest()
+        elif run != viewer.run or not number.isdigit():
+            last = 0
+        else:
+            last = min(int(number), viewer.latest())
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            self.wfile.write('retry: 2000\n\n')
+            self.wfile.flush()
+            while viewer.running:
+                latest = viewer.wait(last, viewer.keepalive)
+                if latest > last:
+                    for cap in viewer.newer(last):
+                        self.wfile.write('id: %s:%d\nevent: capture\n'
+                                         'data: %s\n\n'
+                                         % (viewer.run, cap.number,
+                                            json.dumps(cap.describe())))
+                    last = latest
+                else:
+                    self.wfile.write(': keepalive\n\n')
+                self.wfile.flush()
+        except socket.error:
+            ## Viewer went away
+            pass
+
+
+class viewerserver(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class webviewer:
+    """
+    HTTP server, run in its own thread, serving the latest captures.
+    The capture path only calls add(), which does bookkeeping and never
+    encodes or waits for a browser.
+    """
+
+    maxscale = 8
+    keepalive = 15
+
+    def __init__(self, host = 'localhost', port = 8080, history = 20):
+        self.history = history
+        self.captures = []
+        self.number = 0
+        self.run = '%x' % int(time.time() * 1000)
+        self.counters = {'requests': 0, 'encodes': 0, 'hits': 0,
+                         'notmodified': 0}
+        self.sources = {}
+        self.cache = encodecache()
+        self.running = False
+        self.cond = threading.Condition()
+        self.server = viewerserver((host, port), viewerhandler)
+        self.server.viewer = self
+        self.thread = None
+
+
+    def address(self):
+        return self.server.server_address
+
+
+    def start(self):
+        """Start the server thread"""
+        self.running = True
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.setDaemon(1)
+        self.thread.start()
+
+
+    def stop(self):
+        """Stop the server thread and release waiting event streams."""
+        if self.thread is not None:
+            with self.cond:
+                self.running = False
+                self.cond.notifyAll()
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.thread = None
+
+
+    def add(self, image):
+        """
+        Publishes a finished page.
+        """
+        if image.height() == 0:
+            return
+        with self.cond:
+            self.number += 1
+            self.captures.append(capture(self.number, image, self.cache))
+            for cap in self.captures[:-self.history]:
+                self.cache.drop(cap.number)
+            del self.captures[:-self.history]
+            self.cond.notifyAll()
+
+
+    def get(self, number = None):
+        """
+        Returns the capture with the given number, or the latest one.
+        """
+        with self.cond:
+            if number is None:
+                return self.captures and self.captures[-1] or None
+            for cap in self.captures:
+                if cap.number == number:
+                    return cap
+        return None
+
+
+    def latest(self):
+        with self.cond:
+            return self.number
+
+
+    def newer(self, number):
+        with self.cond:
+            return [cap for cap in self.captures if cap.number > number]
+
+
+    def wait(self, number, timeout):
+        """
+        Waits for a capture newer than number, at most timeout seconds.
+        Returns the number of the latest capture.
+        """
+        with self.cond:
+            if self.number <= number and self.running:
+                self.cond.wait(timeout)
+            return self.number
+
+
+    def describe(self):
+        with self.cond:
+            return [cap.describe() for cap in self.captures]
+
+
+    def count(self, counter):
+        with self.cond:
+            self.counters[counter] += 1
+
+
+    def addstats(self, name, function):
+        """
+        Adds the dictionary returned by function to the statistics.
+        """
+        self.sources[name] = function
+
+
+    def statistics(self):
+        with self.cond:
+            stats = dict(self.counters)
+            captures = list(self.captures)
+        stats['captures'] = len(captures)
+        stats['cachebytes'] = self.cache.bytes
+        stats['cachemaxbytes'] = self.cache.maxbytes
+        for (name, function) in self.sources.items():
+            stats[name] = function()
+        return stats
+
+
+if __name__ == '__main__':
+
+    ## Test of the server with a local HTTP client
+    import urllib2
+    import serialrx
+
+    def status(url, headers = {}):
+        try:
+            return urllib2.urlopen(urllib2.Request(url, headers = headers))
+        except urllib2.HTTPError as e:
+            return e
+
+    viewer = webviewer(port = 0)
+    viewer.start()
+    base = 'http://%s:%d' % viewer.address()
+    fd = open('../samples/HP-E8285A/rx-test.txt', 'rb')
+    image = serialrx.pages(fd.read())[0]
+    fd.close()
+
+    ## Event stream, read with a plain socket as urllib2 buffers
+    events = socket.create_connection(viewer.address())
+    events.settimeout(5)
+    events.sendall('GET /events HTTP/1.0\r\n\r\n')
+    stream = ''
+    while 'retry' not in stream:
+        stream += events.recv(4096)
+
+    viewer.add(image)
+    while 'event: capture' not in stream:
+        stream += events.recv(4096)
+    events.close()
+    pushed = stream[stream.index('\nid: ') + 1:].splitlines()
+    print("SSE push: %s" % pushed[0:2])
+
+    reply = status(base + '/latest.png')
+    data = reply.read()
+    etag = reply.info()['ETag']
+    print("PNG: %d %s, %d bytes, signature %s, ETag %s"
+          % (reply.code, reply.info()['Content-Type'], len(data),
+             data[:8] == '\x89PNG\r\n\x1a\n' and 'ok' or 'bad', etag))
+    print("If-None-Match: %d" % status(base + '/1.png',
+                                       {'If-None-Match': etag}).code)
+    print("Bad scale: %d" % status(base + '/1.png?scale=99').code)
+    print("Unknown capture: %d" % status(base + '/7.png').code)
+    print("Unknown path: %d" % status(base + '/foo').code)
+    viewer.stop()